@@ -1,5 +1,10 @@
 # agent/dspy_signatures.py
 
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
 import dspy
 from typing import List, Dict, Any
 
@@ -12,18 +17,73 @@ from typing import List, Dict, Any
 # Model: phi3.5:3.8b-mini-instruct-q4_K_M (or any other model you've pulled)
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import re
 import ast
 
+# Response-parsing patterns, compiled once at import time.
+_FIELD_NAMES = ("final_answer", "explanation", "citations", "sql")
+_MARKER_RES = {
+    fld: re.compile(r"\[+\s*##\s*" + re.escape(fld) + r"\s*##\s*\]+\s*(.*?)(?=(\n\[|\Z))", re.S | re.I)
+    for fld in _FIELD_NAMES
+}
+_HEADING_RES = {
+    "final_answer": re.compile(r"Final Answer:\s*(.*?)($|\n\n|\n\[)", re.I | re.S),
+    "explanation": re.compile(r"Explanation[:\-]?\s*(.*?)($|\n\n|\n\[)", re.I | re.S),
+    "citations": re.compile(r"Citations?:\s*(.*?)($|\n\n|\n\[)", re.I | re.S),
+}
+_CITATIONS_SPLIT = re.compile(r"\n|;|,")
+_CODEFENCE_RE = re.compile(r"^```[a-zA-Z]*\n?(.*?)```", re.S)
+_SQ_TO_DQ = re.compile(r"(?<!\\)'")
+# Any DSPy field marker or answer heading means the text is structured output
+_STRUCTURE_RE = re.compile(r"\[+\s*##|Final Answer:|Explanation[:\-]|Citations?:", re.I)
+_SQL_KEYWORDS = frozenset({"SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "CREATE"})
+
+
+def _starts_with_sql_keyword(text: str) -> bool:
+    """True if the (already stripped) text opens with a SQL statement keyword."""
+    # The longest keyword is 6 chars, so 7 chars are enough to see where it ends
+    head = text[:7].split(None, 1)
+    return bool(head) and head[0].upper() in _SQL_KEYWORDS
+
+logger = logging.getLogger(__name__)
+
 class OllamaDSPyWrapper(dspy.BaseLM):
     """Wrapper to make Ollama compatible with DSPy"""
-    def __init__(self, model: str, base_url: str = "http://localhost:11434"):
+    def __init__(
+        self,
+        model: str,
+        base_url: str = "http://localhost:11434",
+        keep_alive: str = "30m",
+        cache_size: int = 512,
+        temperature: float = 0.0,
+    ):
         super().__init__(model=model)
         self.model = model
         self.base_url = base_url
+        # Keep the model (and its prompt KV-cache) resident between calls so
+        # consecutive requests sharing a prompt prefix skip most of prefill.
+        self.keep_alive = keep_alive
         self.history = []
-        self.kwargs = {}  # Required by DSPy BaseLM
+        # Required by DSPy BaseLM; also the defaults for every request
+        self.kwargs = {"temperature": temperature}
+
+        # In-memory LRU of normalized responses, keyed by sha256 of
+        # (model, prompt, temperature). Only deterministic (temperature=0,
+        # the default) calls are cached, so sampling behaviour is unchanged.
+        self.cache_size = cache_size
+        self._response_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+        # One keep-alive session per wrapper so router/planner/nl2sql/synth
+        # calls reuse the same TCP connection instead of reconnecting.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
     
     def basic_request(self, prompt: str, **kwargs):
         """Make a basic request to Ollama and normalize the returned text.
@@ -33,14 +93,18 @@ class OllamaDSPyWrapper(dspy.BaseLM):
         "sql: " so DSPy's JSON/Text adapters can detect the field.
         """
         try:
-            response = requests.post(
+            payload = {
+                "model": self.model,
+                "prompt": prompt,
+                "stream": False,
+                # Ollama only reads sampling parameters from "options"
+                "options": {"temperature": kwargs.get("temperature", self.kwargs["temperature"])},
+                "keep_alive": self.keep_alive,
+            }
+
+            response = self.session.post(
                 f"{self.base_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": prompt,
-                    "stream": False,
-                    "temperature": kwargs.get("temperature", 0.7),
-                },
+                json=payload,
                 timeout=300,
             )
             response.raise_for_status()
@@ -48,7 +112,8 @@ class OllamaDSPyWrapper(dspy.BaseLM):
 
             # Ollama responses vary; try common locations for the text
             text = ""
-            print("ollama result:",result)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("ollama result: %s", result)
             if isinstance(result, dict):
                 # new Ollama shape: maybe 'response' or 'choices' or 'results'
                 text = result.get("response") or ""
@@ -69,172 +134,270 @@ class OllamaDSPyWrapper(dspy.BaseLM):
             if not text:
                 text = "".join(response.iter_lines(decode_unicode=True))
 
-            # If the LM returned a Python-dict-like string (single quotes), try to parse it
-            parsed = None
-            try:
-                if isinstance(text, str) and text.strip().startswith("{"):
+            return self._normalize_response(text)
+        except requests.exceptions.ReadTimeout as e:
+            raise RuntimeError(f"Ollama read timeout: {str(e)}")
+        except Exception as e:
+            raise RuntimeError(f"Ollama connection failed: {str(e)}")
+
+    def chat(self, messages: list, **kwargs) -> str:
+        """Send chat messages to Ollama's /api/chat and normalize the reply.
+
+        Roles are passed through natively instead of being flattened into
+        one prompt. The reply is fetched as a single JSON body: nothing
+        consumes partial output, so streaming would only add per-token
+        parsing.
+        """
+        try:
+            payload = {
+                "model": self.model,
+                "messages": [
+                    m if isinstance(m, dict) else {"role": "user", "content": str(m)}
+                    for m in messages
+                ],
+                "stream": False,
+                # Ollama only reads sampling parameters from "options"
+                "options": {"temperature": kwargs.get("temperature", self.kwargs["temperature"])},
+                "keep_alive": self.keep_alive,
+            }
+            response = self.session.post(
+                f"{self.base_url}/api/chat",
+                json=payload,
+                timeout=300,
+            )
+            response.raise_for_status()
+            result = response.json()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("ollama result: %s", result)
+            if result.get("error"):
+                raise RuntimeError(result["error"])
+            text = (result.get("message") or {}).get("content") or ""
+            return self._normalize_response(text)
+        except requests.exceptions.ReadTimeout as e:
+            raise RuntimeError(f"Ollama read timeout: {str(e)}")
+        except Exception as e:
+            raise RuntimeError(f"Ollama connection failed: {str(e)}")
+
+    def preload(self):
+        """Load the model into Ollama's memory without generating anything.
+
+        An empty prompt makes Ollama load the weights and keep them for
+        ``keep_alive``, so the first real call doesn't pay the load time.
+        """
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/generate",
+                json={"model": self.model, "prompt": "", "keep_alive": self.keep_alive},
+                timeout=300,
+            )
+            response.raise_for_status()
+        except Exception as e:
+            raise RuntimeError(f"Ollama preload failed: {str(e)}")
+
+    def _normalize_response(self, text: str) -> str:
+        """Turn raw LM text into the field JSON DSPy's adapters expect."""
+        # If the LM returned a Python-dict-like string (single quotes), try to parse it
+        parsed = None
+        try:
+            if isinstance(text, str) and text.strip().startswith("{"):
+                try:
+                    parsed = json.loads(text)
+                except Exception:
+                    # Python-dict-like output: swap single quotes for double
+                    # quotes and retry the (much cheaper) JSON parser first
                     try:
-                        parsed = json.loads(text)
+                        parsed = json.loads(_SQ_TO_DQ.sub('"', text))
                     except Exception:
-                        # try python literal (single quotes)
+                        # last resort: full python literal parse
                         try:
                             parsed = ast.literal_eval(text)
                         except Exception:
                             parsed = None
-            except Exception:
-                parsed = None
-
-            # If parsed is a dict and contains typical fields, extract
-            if isinstance(parsed, dict):
-                # If it contains a nested 'text' field, use that
-                if "text" in parsed and isinstance(parsed["text"], str):
-                    text = parsed["text"]
-                else:
-                    # If parsed already contains the expected output fields (final_answer, explanation, citations, sql), validate and return it as JSON
-                    keys = set(parsed.keys())
-                    wanted = {"final_answer", "explanation", "citations", "sql"}
-                    if keys & wanted:
-                        # Ensure all typical fields exist before returning
-                        if "final_answer" not in parsed:
-                            parsed["final_answer"] = parsed.get("sql", "")
-                        if "explanation" not in parsed:
-                            parsed["explanation"] = ""
-                        if "citations" not in parsed:
-                            parsed["citations"] = []
-                        # Validate JSON serialization
-                        try:
-                            return json.dumps(parsed)
-                        except Exception:
-                            # If serialization fails, continue to heuristic extraction
-                            pass
-
-            # Strip markdown code fences ```sql or ```
-            if text.startswith("```") and "```" in text[3:]:
-                parts = text.split("```", 2)
-                if len(parts) >= 3:
-                    inner = parts[2]
-                    inner = inner.rsplit("```", 1)[0]
-                    text = inner.strip()
-
-            # Heuristics: extract structured fields using markers or headings
-            out = {}
-
-            # 1) Marker-style: [[ ## final_answer ## ]] ... [ ## explanation ## ] ... [ ## citations ## ]
-            def extract_marker(field_name, txt):
-                pattern = re.compile(r"\[+\s*##\s*" + re.escape(field_name) + r"\s*##\s*\]+\s*(.*?)(?=(\n\[|\Z))", re.S | re.I)
-                m = pattern.search(txt)
-                if m:
-                    return m.group(1).strip()
-                return None
-
-            for fld in ("final_answer", "explanation", "citations", "sql"):
-                val = extract_marker(fld, text)
+        except Exception:
+            parsed = None
+
+        # If parsed is a dict and contains typical fields, extract
+        if isinstance(parsed, dict):
+            # If it contains a nested 'text' field, use that
+            if "text" in parsed and isinstance(parsed["text"], str):
+                text = parsed["text"]
+            else:
+                # If parsed already contains the expected output fields (final_answer, explanation, citations, sql), validate and return it as JSON
+                keys = set(parsed.keys())
+                wanted = {"final_answer", "explanation", "citations", "sql"}
+                if keys & wanted:
+                    # Ensure all typical fields exist before returning
+                    if "final_answer" not in parsed:
+                        parsed["final_answer"] = parsed.get("sql", "")
+                    if "explanation" not in parsed:
+                        parsed["explanation"] = ""
+                    if "citations" not in parsed:
+                        parsed["citations"] = []
+                    # Validate JSON serialization
+                    try:
+                        return json.dumps(parsed)
+                    except Exception:
+                        # If serialization fails, continue to heuristic extraction
+                        pass
+
+        # Strip markdown code fences ```sql or ```
+        m = _CODEFENCE_RE.match(text)
+        if m:
+            text = m.group(1).strip()
+
+        # Fast path: a bare SQL statement (typical nl2sql output) needs
+        # none of the marker/heading heuristics below. Prose that merely
+        # opens with a keyword ("With a 14 day window...") still carries a
+        # marker or heading, so it falls through.
+        stripped = text.strip()
+        if _starts_with_sql_keyword(stripped) and not _STRUCTURE_RE.search(stripped):
+            return json.dumps({
+                "sql": stripped,
+                "final_answer": stripped,
+                "explanation": "",
+                "citations": [],
+                "route": "sql",
+                "plan": {},
+            })
+
+        # Heuristics: extract structured fields using markers or headings
+        out = {}
+
+        # 1) Marker-style: [[ ## final_answer ## ]] ... [ ## explanation ## ] ... [ ## citations ## ]
+        for fld, pattern in _MARKER_RES.items():
+            m = pattern.search(text)
+            if m:
+                val = m.group(1).strip()
                 if val:
                     out[fld] = val
 
-            # 2) Heading-style: 'Final Answer:' 'Explanation:' 'Citations:'
-            if "final_answer" not in out:
-                m = re.search(r"Final Answer:\s*(.*?)($|\n\n|\n\[)", text, re.I | re.S)
-                if m:
-                    out["final_answer"] = m.group(1).strip()
-
-            if "explanation" not in out:
-                m = re.search(r"Explanation[:\-]?\s*(.*?)($|\n\n|\n\[)", text, re.I | re.S)
-                if m:
-                    out["explanation"] = m.group(1).strip()
-
-            if "citations" not in out:
-                m = re.search(r"Citations?:\s*(.*?)($|\n\n|\n\[)", text, re.I | re.S)
-                if m:
-                    ctext = m.group(1).strip()
-                    # split by newlines or semicolons
-                    items = [ln.strip() for ln in re.split(r"\n|;|,", ctext) if ln.strip()]
-                    out["citations"] = items if items else [ctext]
-
-            # 3) If nothing structured found, but the text is SQL-like, prefix as before
-            sql_like = False
-            first_token = text.strip().split(None, 1)[:1]
-            if first_token:
-                tok = first_token[0].upper()
-                if tok in {"SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "CREATE"}:
-                    sql_like = True
-
-            if sql_like and "sql" not in out:
-                out["sql"] = text.strip()
-
-            # If we extracted some fields, populate defaults for missing fields and return JSON
-            if out:
-                # Map common field names to expected output names
-                mapped = dict(out)
-                
-                # Smart mapping: if we have final_answer but need route, use it
-                if "route" not in mapped:
-                    for candidate_key in ["explanation", "final_answer", "plan"]:
-                        if candidate_key in mapped:
-                            val = str(mapped[candidate_key]).lower()
-                            for route_type in ["rag", "sql", "hybrid"]:
-                                if route_type in val:
-                                    mapped["route"] = route_type
-                                    break
-                            if "route" in mapped:
+        # 2) Heading-style: 'Final Answer:' 'Explanation:' 'Citations:'
+        if "final_answer" not in out:
+            m = _HEADING_RES["final_answer"].search(text)
+            if m:
+                out["final_answer"] = m.group(1).strip()
+
+        if "explanation" not in out:
+            m = _HEADING_RES["explanation"].search(text)
+            if m:
+                out["explanation"] = m.group(1).strip()
+
+        if "citations" not in out:
+            m = _HEADING_RES["citations"].search(text)
+            if m:
+                ctext = m.group(1).strip()
+                # split by newlines or semicolons
+                items = [ln.strip() for ln in _CITATIONS_SPLIT.split(ctext) if ln.strip()]
+                out["citations"] = items if items else [ctext]
+
+        # If we extracted some fields, populate defaults for missing fields and return JSON
+        if out:
+            # Map common field names to expected output names
+            mapped = dict(out)
+            
+            # Smart mapping: if we have final_answer but need route, use it
+            if "route" not in mapped:
+                for candidate_key in ["explanation", "final_answer", "plan"]:
+                    if candidate_key in mapped:
+                        val = str(mapped[candidate_key]).lower()
+                        for route_type in ["rag", "sql", "hybrid"]:
+                            if route_type in val:
+                                mapped["route"] = route_type
                                 break
-                
-                if "sql" not in mapped:
-                    for candidate_key in ["explanation", "final_answer"]:
-                        if candidate_key in mapped and "select" in str(mapped[candidate_key]).lower():
-                            mapped["sql"] = mapped[candidate_key]
+                        if "route" in mapped:
                             break
-                
-                # Ensure all common fields have at least an empty value
-                if "final_answer" not in mapped:
-                    mapped["final_answer"] = mapped.get("sql", mapped.get("explanation", text.strip()[:200]))
-                if "explanation" not in mapped:
-                    mapped["explanation"] = ""
-                if "citations" not in mapped:
-                    mapped["citations"] = []
-                if "route" not in mapped:
-                    mapped["route"] = "hybrid"
-                if "sql" not in mapped:
-                    mapped["sql"] = ""
-                if "plan" not in mapped:
-                    mapped["plan"] = {}
-                
-                return json.dumps(mapped)
-
-            # As a last resort return the raw text
-            return text
-        except requests.exceptions.ReadTimeout as e:
-            raise RuntimeError(f"Ollama read timeout: {str(e)}")
-        except Exception as e:
-            raise RuntimeError(f"Ollama connection failed: {str(e)}")
+            
+            if "sql" not in mapped:
+                for candidate_key in ["explanation", "final_answer"]:
+                    if candidate_key in mapped and "select" in str(mapped[candidate_key]).lower():
+                        mapped["sql"] = mapped[candidate_key]
+                        break
+            
+            # Ensure all common fields have at least an empty value
+            if "final_answer" not in mapped:
+                mapped["final_answer"] = mapped.get("sql", mapped.get("explanation", text.strip()[:200]))
+            if "explanation" not in mapped:
+                mapped["explanation"] = ""
+            if "citations" not in mapped:
+                mapped["citations"] = []
+            if "route" not in mapped:
+                mapped["route"] = "hybrid"
+            if "sql" not in mapped:
+                mapped["sql"] = ""
+            if "plan" not in mapped:
+                mapped["plan"] = {}
+            
+            return json.dumps(mapped)
+
+        # As a last resort return the raw text
+        return text
     
     def __call__(self, prompt: str = None, messages: list = None, **kwargs):
         """Handle both prompt-based and message-based calls.
 
-        DSPy sometimes calls LMs with `messages=`; support that shape by
-        converting to a single prompt. Return a list of outputs as DSPy
+        DSPy sometimes calls LMs with `messages=`; those are sent to
+        /api/chat with their roles intact. Return a list of outputs as DSPy
         expects.
         """
         if messages:
-            # Convert messages to a single prompt string
-            prompt_text = ""
-            for msg in messages:
-                if isinstance(msg, dict):
-                    role = msg.get("role", "").upper()
-                    content = msg.get("content", "")
-                    prompt_text += f"{role}: {content}\n"
-                else:
-                    prompt_text += str(msg) + "\n"
-            prompt = prompt_text
+            # Flatten messages to a single string (one join, no repeated +=);
+            # used as the cache key for the chat request
+            prompt = "".join(
+                f"{msg.get('role', '').upper()}: {msg.get('content', '')}\n"
+                if isinstance(msg, dict)
+                else f"{msg}\n"
+                for msg in messages
+            )
 
         if not prompt:
             raise ValueError("Either 'prompt' or 'messages' must be provided")
 
-        response_text = self.basic_request(prompt, **kwargs)
+        # Resolve the temperature once so the request and the cache key agree
+        temperature = kwargs.get("temperature", self.kwargs["temperature"])
+        kwargs["temperature"] = temperature
+        if temperature != 0 or self.cache_size <= 0:
+            return [self._request(prompt, messages, **kwargs)]
+
+        key = self._cache_key(prompt, temperature, chat=bool(messages))
+        with self._cache_lock:
+            response_text = self._response_cache.get(key)
+            if response_text is not None:
+                self._response_cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return [response_text]
+            self.stats["misses"] += 1
+
+        response_text = self._request(prompt, messages, **kwargs)
+
+        with self._cache_lock:
+            self._response_cache[key] = response_text
+            self._response_cache.move_to_end(key)
+            while len(self._response_cache) > self.cache_size:
+                self._response_cache.popitem(last=False)
 
         # DSPy expects a list of strings (one completion per returned item)
         return [response_text]
     
+    def _request(self, prompt: str, messages: list = None, **kwargs) -> str:
+        if messages:
+            return self.chat(messages, **kwargs)
+        return self.basic_request(prompt, **kwargs)
+
+    def _cache_key(self, prompt: str, temperature, chat: bool = False) -> str:
+        raw = json.dumps(
+            {"model": self.model, "prompt": prompt, "temp": temperature, "chat": chat},
+            sort_keys=True,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def acall(self, prompt: str = None, messages: list = None, **kwargs):
+        """Async counterpart of __call__ for DSPy's async code paths.
+
+        The HTTP request itself stays blocking, so it runs on a worker
+        thread.
+        """
+        return await asyncio.to_thread(self.__call__, prompt, messages, **kwargs)
+
     def forward(self, prompt: str, **kwargs) -> str:
         """Forward pass using Ollama API"""
         return self.basic_request(prompt, **kwargs)
@@ -267,9 +430,11 @@ class PlanQuery(dspy.Signature):
 # ============================================================
 
 class GenerateSQL(dspy.Signature):
+    # Schema first: it is identical across questions, so it forms a stable
+    # prompt prefix that Ollama can serve from its KV-cache.
+    schema = dspy.InputField()
     question = dspy.InputField()
     plan = dspy.InputField()
-    schema = dspy.InputField()
     sql = dspy.OutputField(desc="Generated SQLite query")
 
 
@@ -286,6 +451,7 @@ class SynthesizeAnswer(dspy.Signature):
     rows = dspy.InputField()
     columns = dspy.InputField()
     tables_used = dspy.InputField()
+    rows_truncated = dspy.InputField(desc="True if rows is only the first part of the SQL result")
 
     final_answer = dspy.OutputField()
     explanation = dspy.OutputField()
@@ -338,6 +504,7 @@ class SynthesizerModule(dspy.Module):
         rows,
         columns,
         tables_used,
+        rows_truncated=False,
     ):
         return self.predict(
             question=question,
@@ -348,14 +515,40 @@ class SynthesizerModule(dspy.Module):
             rows=rows,
             columns=columns,
             tables_used=tables_used,
+            rows_truncated=rows_truncated,
         )
 
 
 # ============================================================
-# Module Instances (Initialized after Ollama config)
+# Module Instances (created on first use, after Ollama config)
 # ============================================================
 
-router = RouterModule()
-planner = PlannerModule()
-nl2sql = NL2SQLModule()
-synth = SynthesizerModule()
+_modules = {}  # module class -> its single instance
+_modules_lock = threading.Lock()
+
+
+def _module(cls):
+    # Double-checked so concurrent first calls still build one instance
+    mod = _modules.get(cls)
+    if mod is None:
+        with _modules_lock:
+            mod = _modules.get(cls)
+            if mod is None:
+                mod = _modules[cls] = cls()
+    return mod
+
+
+def get_router() -> RouterModule:
+    return _module(RouterModule)
+
+
+def get_planner() -> PlannerModule:
+    return _module(PlannerModule)
+
+
+def get_nl2sql() -> NL2SQLModule:
+    return _module(NL2SQLModule)
+
+
+def get_synth() -> SynthesizerModule:
+    return _module(SynthesizerModule)
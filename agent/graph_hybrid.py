@@ -2,19 +2,22 @@
 
 from __future__ import annotations
 import json
-from typing import Dict, Any, Optional
+import re
+import threading
+from typing import Dict, Any, FrozenSet, Optional
 
-from langgraph.graph import StateGraph, END
+from langgraph.graph import StateGraph, START, END
 from langgraph.checkpoint.memory import MemorySaver
 from typing_extensions import TypedDict
 
 from agent.rag.retrieval import LocalDocRetriever
 from agent.tools.sqlite_tool import SQLiteTool
 from agent.dspy_signatures import (
-    router,
-    planner,
-    nl2sql,
-    synth,
+    ollama_lm,
+    get_router,
+    get_planner,
+    get_nl2sql,
+    get_synth,
 )
 
 
@@ -26,7 +29,7 @@ class AgentState(TypedDict):
     """
     Shared state object for LangGraph. Keys include:
     question, format_hint, route, retrieved_docs, plan,
-    sql, sql_result, rows, columns, error, citations,
+    sql, sql_result, rows, columns, rows_truncated, error, citations,
     final_answer, confidence
     """
     question: str
@@ -39,6 +42,7 @@ class AgentState(TypedDict):
     rows: list
     columns: list
     tables_used: list
+    rows_truncated: bool
     error: Optional[str]
     citations: list
     final_answer: str
@@ -47,43 +51,139 @@ class AgentState(TypedDict):
 
 
 # ============================================================
-# Core Agent Components
+# Core Agent Components (built on first use, not at import)
 # ============================================================
 
-retriever = LocalDocRetriever("docs/")
-sql_tool = SQLiteTool("data/northwind.sqlite")
+_components = {}  # name -> shared instance
+_components_lock = threading.RLock()
+
+
+def _component(name: str, factory):
+    """
+    Return the shared instance for `name`, building it with `factory` once.
+    Double-checked under a lock: concurrent first calls (thread pool,
+    asyncio.gather, parallel graph branches) must not build duplicates.
+    """
+    obj = _components.get(name)
+    if obj is None:
+        with _components_lock:
+            obj = _components.get(name)
+            if obj is None:
+                obj = _components[name] = factory()
+    return obj
+
+
+def get_retriever() -> LocalDocRetriever:
+    return _component("retriever", lambda: LocalDocRetriever("docs/"))
+
+
+def get_sql_tool() -> SQLiteTool:
+    return _component("sql_tool", lambda: SQLiteTool("data/northwind.sqlite"))
 
 
 # ============================================================
 # Node: Router
 # ============================================================
 
-def node_router(state: AgentState) -> AgentState:
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+_CAMEL_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+# Cue words for the rule-based router
+_AGGREGATION_WORDS = frozenset({
+    "sum", "count", "avg", "average", "total", "top", "list",
+    "highest", "lowest", "most", "least", "max", "min", "many",
+})
+_DOC_WORDS = frozenset({
+    "why", "explain", "describe", "policy", "document", "docs",
+    "according", "definition", "defined", "calendar", "kpi",
+})
+
+
+# Filled by _schema_tokens on the first successful schema read
+_schema_token_cache: Optional[FrozenSet[str]] = None
+
+
+def _schema_tokens() -> FrozenSet[str]:
+    """
+    Lower-cased table/column names from the DB schema, plus their CamelCase
+    parts and singular forms ("OrderDate" -> orderdate, order, date).
+    Built once; if the schema can't be read, an empty set is returned
+    without caching it, so the next call tries again.
+    """
+    global _schema_token_cache
+    if _schema_token_cache is not None:
+        return _schema_token_cache
+
+    try:
+        schema = get_sql_tool().get_schema_snapshot()
+    except Exception:
+        return frozenset()
+
+    tokens = set()
+    for name in [*schema, *(c for cols in schema.values() for c in cols)]:
+        parts = [name.replace(" ", "")] + _CAMEL_RE.findall(name)
+        for part in parts:
+            part = part.lower()
+            if len(part) < 3:
+                continue
+            tokens.add(part)
+            if part.endswith("ies"):
+                tokens.add(part[:-3] + "y")
+            elif part.endswith("s"):
+                tokens.add(part[:-1])
+
+    _schema_token_cache = frozenset(tokens)
+    return _schema_token_cache
+
+
+def _rule_router(question: str, schema_tokens: FrozenSet[str]) -> Optional[str]:
+    """
+    Cheap keyword routing; returns None when the question is ambiguous and
+    the LLM router should decide.
+    """
+    words = set(_WORD_RE.findall(question.lower()))
+    schema_hits = len(words & schema_tokens)
+    aggregates = bool(words & _AGGREGATION_WORDS)
+    wants_docs = bool(words & _DOC_WORDS)
+
+    if wants_docs and schema_hits and aggregates:
+        return "hybrid"
+    if schema_hits >= 2 and aggregates:
+        return "sql"
+    if wants_docs:
+        return "rag"
+    return None
+
+
+def node_router(state: AgentState) -> Dict[str, Any]:
+    # Runs in the same step as node_retrieve, so only the keys this node
+    # owns are returned (parallel branches cannot both write full state).
     q = state["question"]
+
+    route = _rule_router(q, _schema_tokens())
+    if route:
+        return {"route": route}
+
     try:
-        out = router(question=q)
+        out = get_router()(question=q)
         route = getattr(out, "route", "hybrid")
         if route:
-            state["route"] = str(route).strip().lower()
-        else:
-            state["route"] = "hybrid"
+            return {"route": str(route).strip().lower()}
+        return {"route": "hybrid"}
     except Exception as e:
         # If router fails, default to hybrid approach
-        state["route"] = "hybrid"
-        state["error"] = f"Router failed: {str(e)[:100]}"
-    return state
+        return {"route": "hybrid", "error": f"Router failed: {str(e)[:100]}"}
 
 
 # ============================================================
 # Node: RAG Retriever
 # ============================================================
 
-def node_retrieve(state: AgentState) -> AgentState:
+def node_retrieve(state: AgentState) -> Dict[str, Any]:
     k = 6
     q = state["question"]
-    docs = retriever.retrieve(q, k=k)
-    state["retrieved_docs"] = docs
-    return state
+    docs = get_retriever().retrieve(q, k=k)
+    return {"retrieved_docs": docs}
 
 
 # ============================================================
@@ -93,7 +193,7 @@ def node_retrieve(state: AgentState) -> AgentState:
 def node_planner(state: AgentState) -> AgentState:
     q = state["question"]
     docs = state.get("retrieved_docs", [])
-    plan_out = planner(question=q, retrieved_docs=docs)
+    plan_out = get_planner()(question=q, retrieved_docs=docs)
     state["plan"] = plan_out.plan
     return state
 
@@ -105,9 +205,10 @@ def node_planner(state: AgentState) -> AgentState:
 def node_sqlgen(state: AgentState) -> AgentState:
     q = state["question"]
     plan = state.get("plan", {})
-    schema = sql_tool.get_schema_snapshot()
     try:
-        sql_out = nl2sql(question=q, plan=plan, schema=schema)
+        # Schema errors (e.g. unreadable DB) propagate from the tool; record them here
+        schema = get_sql_tool().get_schema_snapshot()
+        sql_out = get_nl2sql()(question=q, plan=plan, schema=schema)
     except Exception as e:
         state["sql"] = ""
         state["sql_result"] = {"error": f"NL2SQL call failed: {e}"}
@@ -143,11 +244,12 @@ def node_sqlexec(state: AgentState) -> AgentState:
         state["sql_result"] = {"error": "Empty SQL."}
         return state
 
-    result = sql_tool.run_sql(query)
+    result = get_sql_tool().run_sql(query)
     state["sql_result"] = result
     state["rows"] = result.get("rows", [])
     state["columns"] = result.get("columns", [])
     state["tables_used"] = result.get("tables_used", [])
+    state["rows_truncated"] = result.get("truncated", False)
     state["error"] = result.get("error")
     return state
 
@@ -165,9 +267,10 @@ def node_synthesize(state: AgentState) -> AgentState:
     rows = state.get("rows", [])
     cols = state.get("columns", [])
     tables = state.get("tables_used", [])
+    truncated = state.get("rows_truncated", False)
 
     try:
-        out = synth(
+        out = get_synth()(
             question=q,
             format_hint=fmt,
             plan=plan,
@@ -176,6 +279,7 @@ def node_synthesize(state: AgentState) -> AgentState:
             rows=rows,
             columns=cols,
             tables_used=tables,
+            rows_truncated=truncated,
         )
     except Exception as e:
         # If synthesis fails (e.g., timeout, parse error), create a fallback answer
@@ -201,21 +305,28 @@ def node_synthesize(state: AgentState) -> AgentState:
 # Node: Repair & Validation
 # ============================================================
 
-def node_validate_or_repair(state: AgentState) -> AgentState:
-    error = state.get("error")
+def node_validate_or_repair(state: AgentState) -> Dict[str, Any]:
+    # Returns only the keys that change; LangGraph merges them into the
+    # existing state, so docs/plan are kept without copying the whole dict.
+    if not state.get("error"):
+        return {}
 
     # SQL failed → attempt repair
-    if error:
-        state.setdefault("repairs", 0)
-        if state["repairs"] >= 2:
-            return state
-
-        # Force a retry: regenerate SQL
-        state["repairs"] += 1
-        new_state = state.copy()
-        new_state["sql"] = ""
-        return new_state  # signals loop
-    return state
+    repairs = state.get("repairs", 0)
+    if repairs >= 2:
+        return {}
+
+    # Force a retry: regenerate SQL, dropping results from the failed attempt
+    return {
+        "repairs": repairs + 1,
+        "sql": "",
+        "error": None,
+        "sql_result": {},
+        "rows": [],
+        "columns": [],
+        "tables_used": [],
+        "rows_truncated": False,
+    }
 
 
 def should_repair(state: AgentState) -> str:
@@ -263,10 +374,11 @@ def build_graph():
     graph.add_node("synthesize", node_synthesize)
     graph.add_node("repair", node_validate_or_repair)
 
-    graph.set_entry_point("router")
-
-    graph.add_edge("router", "retrieve")
-    graph.add_edge("retrieve", "planner")
+    # Router and retrieval only depend on the question, so both start
+    # from the entry point and the planner waits for the two of them.
+    graph.add_edge(START, "router")
+    graph.add_edge(START, "retrieve")
+    graph.add_edge(["router", "retrieve"], "planner")
     graph.add_edge("planner", "sqlgen")
     graph.add_edge("sqlgen", "sqlexec")
     graph.add_edge("sqlexec", "synthesize")
@@ -290,19 +402,33 @@ def build_graph():
 # API for run_agent_hybrid.py
 # ============================================================
 
-agent_graph = build_graph()
+def get_agent_graph():
+    return _component("graph", build_graph)
 
 
-def run_hybrid_agent(question: str, format_hint: str, checkpoint_config: Optional[dict] = None) -> Dict[str, Any]:
+def warm(preload_model: bool = True) -> None:
     """
-    Entrypoint used by run_agent_hybrid.py
-    Returns the final JSON output contract.
+    Build everything run_hybrid_agent creates lazily (retriever index,
+    DB connections and schema, router tokens, DSPy modules, compiled graph)
+    so the first question doesn't pay for it. With preload_model, also ask
+    Ollama to load the model; that step runs last and may raise if the
+    server is unreachable.
     """
-    if checkpoint_config is None:
-        checkpoint_config = {"thread_id": "main_thread"}
-
+    get_retriever()
+    get_sql_tool().get_schema_snapshot()
+    _schema_tokens()
+    get_router()
+    get_planner()
+    get_nl2sql()
+    get_synth()
+    get_agent_graph()
+    if preload_model:
+        ollama_lm.preload()
+
+
+def _initial_state(question: str, format_hint: str) -> AgentState:
     # Ensure the input is a proper AgentState with ALL required keys
-    inputs: AgentState = {
+    return {
         "question": question,
         "format_hint": format_hint,
         "route": "",
@@ -313,6 +439,7 @@ def run_hybrid_agent(question: str, format_hint: str, checkpoint_config: Optiona
         "rows": [],
         "columns": [],
         "tables_used": [],
+        "rows_truncated": False,
         "error": None,
         "citations": [],
         "final_answer": "",
@@ -320,10 +447,9 @@ def run_hybrid_agent(question: str, format_hint: str, checkpoint_config: Optiona
         "repairs": 0,
     }
 
-    # invoke the LangGraph
-    out = agent_graph.invoke(inputs, config=checkpoint_config)
 
-    final = {
+def _final_output(out: AgentState) -> Dict[str, Any]:
+    return {
         "id": "",
         "final_answer": out.get("final_answer", ""),
         "sql": out.get("sql", ""),
@@ -331,4 +457,29 @@ def run_hybrid_agent(question: str, format_hint: str, checkpoint_config: Optiona
         "explanation": out.get("explanation", ""),
         "citations": out.get("citations", []),
     }
-    return final
+
+
+def run_hybrid_agent(question: str, format_hint: str, checkpoint_config: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    Entrypoint used by run_agent_hybrid.py
+    Returns the final JSON output contract.
+    """
+    if checkpoint_config is None:
+        checkpoint_config = {"thread_id": "main_thread"}
+
+    # invoke the LangGraph
+    out = get_agent_graph().invoke(_initial_state(question, format_hint), config=checkpoint_config)
+    return _final_output(out)
+
+
+async def arun_hybrid_agent(question: str, format_hint: str, checkpoint_config: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    Async variant of run_hybrid_agent for callers already on an event loop.
+
+    Several questions can be awaited together (e.g. with asyncio.gather).
+    """
+    if checkpoint_config is None:
+        checkpoint_config = {"thread_id": "main_thread"}
+
+    out = await get_agent_graph().ainvoke(_initial_state(question, format_hint), config=checkpoint_config)
+    return _final_output(out)
@@ -2,10 +2,29 @@
 
 import os
 import json
-from typing import List, Dict, Any
+import pickle
+import hashlib
+import tempfile
+import functools
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from rank_bm25 import BM25Okapi
+import numpy as np
+import sklearn
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+# Okapi BM25 parameters (same defaults as rank_bm25.BM25Okapi)
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+# Word tokens for BM25 (punctuation is dropped, so "days?" matches "days")
+TOKEN_PATTERN = r"(?u)\b\w+\b"
+
+# Bump when the on-disk index layout or scoring inputs change
+INDEX_CACHE_VERSION = 1
 
 
 class LocalDocRetriever:
@@ -17,17 +36,41 @@ class LocalDocRetriever:
     - Returns top-k relevant chunks with IDs + scores
     """
 
-    def __init__(self, docs_path: str = "docs/", chunk_size: int = 1):
+    def __init__(
+        self,
+        docs_path: str = "docs/",
+        chunk_size: int = 1,
+        cache_size: int = 512,
+        index_cache_dir: Optional[str] = ".cache",
+    ):
         self.docs_path = docs_path
         self.chunk_size = chunk_size
-        self.chunks = []            # list[{id, text, source}]
-        self.tokenized_chunks = []  # list[list[str]]
-        self.bm25 = None
+        self.cache_size = cache_size
+        # Built indexes are persisted here, keyed by the docs' names/mtimes/sizes;
+        # None disables the on-disk index cache
+        self.index_cache_dir = index_cache_dir
+        # Chunks are stored column-wise: row i of each list is one chunk
+        self.chunk_ids = []         # list[str]
+        self.chunk_texts = []       # list[str]
+        self.chunk_sources = []     # list[str]
+        self.bm25 = None            # CSC matrix of per-(chunk, term) BM25 weights
+        self.bm25_vocab = {}        # term -> column in self.bm25
+        self._counter = None        # fitted CountVectorizer behind bm25_vocab
+        self._analyzer = None       # text -> list of BM25 tokens
+        # query -> (BM25 columns, TF-IDF vector); shared by every k for a query
+        self._encode_query = functools.lru_cache(maxsize=256)(self._encode_query_uncached)
         self.tfidf = None
         self.vectorizer = None
 
-        self._load_docs()
-        self._build_indexes()
+        # (query, k) -> results; the corpus is fixed once indexed, so repeated
+        # questions (eval loops, repair retries) skip scoring entirely.
+        self._retrieve_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        if not self._load_index_cache():
+            self._load_docs()
+            self._build_indexes()
+            self._save_index_cache()
 
     def _load_docs(self):
         """
@@ -45,62 +88,263 @@ class LocalDocRetriever:
                 p.strip() for p in content.split("\n\n") if p.strip()
             ]
 
-            for i, paragraph in enumerate(paragraphs):
-                chunk_id = f"{filename.replace('.md','')}::chunk{i}"
-                self.chunks.append({
-                    "id": chunk_id,
-                    "text": paragraph,
-                    "source": filename
-                })
+            doc_name = filename.replace('.md', '')
+            self.chunk_ids.extend(f"{doc_name}::chunk{i}" for i in range(len(paragraphs)))
+            self.chunk_texts.extend(paragraphs)
+            self.chunk_sources.extend([filename] * len(paragraphs))
 
-        print(f"[RAG] Loaded {len(self.chunks)} chunks from docs/")
+        print(f"[RAG] Loaded {len(self.chunk_ids)} chunks from docs/")
 
     def _build_indexes(self):
         """
         Build BM25 and TF-IDF indexes.
         """
-        # Tokenize for BM25
-        self.tokenized_chunks = [
-            chunk["text"].lower().split() for chunk in self.chunks
-        ]
+        texts = self.chunk_texts
 
-        # Build BM25 index
-        self.bm25 = BM25Okapi(self.tokenized_chunks)
+        # BM25: precompute every (chunk, term) weight once so that query
+        # scoring is a single sparse column-sum instead of a Python loop.
+        # The vectorizer's compiled analyzer tokenizes the whole corpus.
+        counter = CountVectorizer(lowercase=True, token_pattern=TOKEN_PATTERN)
+        counts = counter.fit_transform(texts)
+        self._counter = counter
+        self.bm25_vocab = counter.vocabulary_
+        self._analyzer = counter.build_analyzer()
+        self.bm25 = self._bm25_weights(counts)
 
         # TF-IDF fallback
         self.vectorizer = TfidfVectorizer()
-        texts = [c["text"] for c in self.chunks]
         self.tfidf = self.vectorizer.fit_transform(texts)
 
+    # -------------------------------------------
+    # On-disk index cache
+    # -------------------------------------------
+    def _corpus_key(self) -> str:
+        """
+        Hash of every markdown file's name, mtime and size (plus index settings
+        and the scikit-learn version the pickled vectorizers belong to).
+        """
+        h = hashlib.sha256(
+            f"v{INDEX_CACHE_VERSION}:{self.chunk_size}:{TOKEN_PATTERN}:{sklearn.__version__};".encode()
+        )
+        for filename in sorted(os.listdir(self.docs_path)):
+            if not filename.endswith(".md"):
+                continue
+            st = os.stat(os.path.join(self.docs_path, filename))
+            h.update(f"{filename}:{st.st_mtime_ns}:{st.st_size};".encode())
+        return h.hexdigest()
+
+    def _index_cache_stem(self) -> str:
+        """
+        File name prefix shared by every cached index of this docs folder.
+        """
+        docs_id = hashlib.sha256(os.path.abspath(self.docs_path).encode()).hexdigest()[:12]
+        return f"rag-{docs_id}-"
+
+    def _index_cache_prefix(self) -> str:
+        return os.path.join(self.index_cache_dir, self._index_cache_stem() + self._corpus_key())
+
+    def _prune_index_cache(self, prefix: str):
+        """
+        Remove this docs folder's cached indexes other than `prefix`
+        (left behind by earlier versions of the docs).
+        """
+        stem = self._index_cache_stem()
+        keep = os.path.basename(prefix)
+        for filename in os.listdir(self.index_cache_dir):
+            if filename.startswith(stem) and not filename.startswith(keep):
+                try:
+                    os.remove(os.path.join(self.index_cache_dir, filename))
+                except OSError:
+                    # e.g. still mapped by another process on Windows; retried next save
+                    pass
+
+    @staticmethod
+    def _write_atomic(path: str, write):
+        """
+        Call write(f) on a private temp file next to `path`, then rename it
+        into place. Readers (possibly mmap'ing the old file) never see a
+        partly written file, and concurrent writers never share a temp file.
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def _save_sparse(cls, prefix: str, matrix):
+        for name in ("data", "indices", "indptr"):
+            arr = getattr(matrix, name)
+            cls._write_atomic(f"{prefix}-{name}.npy", lambda f: np.save(f, arr))
+
+    @staticmethod
+    def _load_sparse(prefix: str, cls, shape):
+        # mmap'd arrays: forked workers share the same pages of the index
+        data, indices, indptr = (
+            np.load(f"{prefix}-{name}.npy", mmap_mode="r")
+            for name in ("data", "indices", "indptr")
+        )
+        return cls((data, indices, indptr), shape=shape, copy=False)
+
+    def _load_index_cache(self) -> bool:
+        """
+        Restore chunks and indexes saved for the current docs; False on a miss.
+        """
+        if not self.index_cache_dir:
+            return False
+        prefix = self._index_cache_prefix()
+        if not os.path.exists(f"{prefix}.pkl"):
+            return False
+        try:
+            with open(f"{prefix}.pkl", "rb") as f:
+                meta = pickle.load(f)
+            self.chunk_ids = meta["chunk_ids"]
+            self.chunk_texts = meta["chunk_texts"]
+            self.chunk_sources = meta["chunk_sources"]
+            self._counter = meta["counter"]
+            self.bm25_vocab = self._counter.vocabulary_
+            self._analyzer = self._counter.build_analyzer()
+            self.vectorizer = meta["vectorizer"]
+            self.bm25 = self._load_sparse(f"{prefix}-bm25", sparse.csc_matrix, meta["bm25_shape"])
+            self.tfidf = self._load_sparse(f"{prefix}-tfidf", sparse.csr_matrix, meta["tfidf_shape"])
+        except Exception as e:
+            print(f"[RAG] Ignoring unreadable index cache {prefix}: {e}")
+            self.chunk_ids, self.chunk_texts, self.chunk_sources = [], [], []
+            return False
+
+        print(f"[RAG] Loaded {len(self.chunk_ids)} chunks from index cache")
+        return True
+
+    def _save_index_cache(self):
+        if not self.index_cache_dir:
+            return
+        prefix = self._index_cache_prefix()
+        if os.path.exists(f"{prefix}.pkl"):
+            # Another worker already saved this exact index; its files may be mmap'd
+            return
+        try:
+            os.makedirs(self.index_cache_dir, exist_ok=True)
+            self._save_sparse(f"{prefix}-bm25", self.bm25)
+            self._save_sparse(f"{prefix}-tfidf", self.tfidf)
+            meta = {
+                "chunk_ids": self.chunk_ids,
+                "chunk_texts": self.chunk_texts,
+                "chunk_sources": self.chunk_sources,
+                "counter": self._counter,
+                "vectorizer": self.vectorizer,
+                "bm25_shape": self.bm25.shape,
+                "tfidf_shape": self.tfidf.shape,
+            }
+            # The .pkl is written last, so its presence marks a complete cache
+            self._write_atomic(
+                f"{prefix}.pkl",
+                lambda f: pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL),
+            )
+            self._prune_index_cache(prefix)
+        except OSError as e:
+            print(f"[RAG] Could not write index cache to {self.index_cache_dir}: {e}")
+
+    @staticmethod
+    def _bm25_weights(counts):
+        """
+        Turn a chunk x term count matrix into Okapi BM25 term weights,
+        matching rank_bm25.BM25Okapi scoring.
+        """
+        # Weights are computed per stored entry, so merge duplicate entries first
+        counts = counts.tocsr()
+        counts.sum_duplicates()
+
+        n_docs = counts.shape[0]
+        tf = counts.data.astype(np.float64)
+        doc_len = np.asarray(counts.sum(axis=1)).ravel()
+        avgdl = doc_len.sum() / n_docs
+
+        df = np.bincount(counts.indices, minlength=counts.shape[1])
+        idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+        idf[idf < 0] = BM25_EPSILON * idf.mean()
+
+        rows = np.repeat(np.arange(n_docs), np.diff(counts.indptr))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[rows] / avgdl)
+
+        weights = counts.astype(np.float64)
+        weights.data = idf[counts.indices] * tf * (BM25_K1 + 1) / (tf + norm)
+        return weights.tocsc()
+
+    def _encode_query_uncached(self, query: str):
+        """
+        Map a query to its BM25 term columns and its TF-IDF vector.
+        """
+        vocab = self.bm25_vocab
+        cols = tuple(vocab[t] for t in self._analyzer(query) if t in vocab)
+        return cols, self.vectorizer.transform([query])
+
+    def _bm25_scores(self, cols) -> np.ndarray:
+        """
+        BM25 score of every chunk for the query's term columns
+        (repeated terms count again).
+        """
+        if not cols:
+            return np.zeros(self.bm25.shape[0], dtype=np.float64)
+        return np.asarray(self.bm25[:, list(cols)].sum(axis=1), dtype=np.float64).ravel()
+
     def retrieve(self, query: str, k: int = 5) -> List[Dict[str, Any]]:
         """
         Retrieve top-k relevant chunks using BM25 + TF-IDF hybrid scoring.
+        Results are memoized per (query, k).
         """
-        query_tokens = query.lower().split()
+        key = (query, k)
+        with self._cache_lock:
+            cached = self._retrieve_cache.get(key)
+            if cached is not None:
+                self._retrieve_cache.move_to_end(key)
+                return [dict(r) for r in cached]
+
+        results = self._retrieve(query, k)
+
+        if self.cache_size > 0:
+            with self._cache_lock:
+                self._retrieve_cache[key] = results
+                while len(self._retrieve_cache) > self.cache_size:
+                    self._retrieve_cache.popitem(last=False)
+        # Callers get their own result dicts; the cached ones are never handed out
+        return [dict(r) for r in results]
+
+    def _retrieve(self, query: str, k: int) -> List[Dict[str, Any]]:
+        bm25_cols, tfidf_query = self._encode_query(query)
 
         # BM25 scores
-        bm25_scores = self.bm25.get_scores(query_tokens)
+        bm25_scores = self._bm25_scores(bm25_cols)
 
         # TF-IDF scores (fallback)
-        tfidf_query = self.vectorizer.transform([query])
-        tfidf_scores = (self.tfidf @ tfidf_query.T).toarray().squeeze()
+        tfidf_scores = (self.tfidf @ tfidf_query.T).toarray().ravel()
 
-        # Combine scores (weighted average)
-        combined = 0.7 * bm25_scores + 0.3 * tfidf_scores
+        # Combine scores (weighted average), in place on the per-call arrays
+        combined = np.multiply(bm25_scores, 0.7, out=bm25_scores)
+        combined += np.multiply(tfidf_scores, 0.3, out=tfidf_scores)
 
-        # Get top-k indices
-        top_idx = combined.argsort()[::-1][:k]
+        # Get top-k indices: O(N) partition, then sort only the k winners
+        n = combined.shape[0]
+        k = min(k, n)
+        if k <= 0:
+            return []
+        if k < n:
+            top = np.argpartition(-combined, k - 1)[:k]
+        else:
+            top = np.arange(n)
+        top_idx = top[np.argsort(-combined[top], kind="stable")]
 
-        results = []
-        for idx in top_idx:
-            results.append({
-                "id": self.chunks[idx]["id"],
-                "text": self.chunks[idx]["text"],
-                "score": float(combined[idx]),
-                "source": self.chunks[idx]["source"]
-            })
-
-        return results
+        # Convert indices and scores to Python objects in bulk, not per item
+        ids, texts, sources = self.chunk_ids, self.chunk_texts, self.chunk_sources
+        return [
+            {"id": ids[i], "text": texts[i], "score": score, "source": sources[i]}
+            for i, score in zip(top_idx.tolist(), combined[top_idx].tolist())
+        ]
 
 
 # Quick test (optional)
@@ -1,9 +1,44 @@
 # agent/tools/sqlite_tool.py
+"""
+SQLite tool used by the agent graph.
 
+Concurrency model: each SQLiteTool holds two lazily opened connections,
+both shared by all threads (check_same_thread=False).
+- A read-write connection for run_sql, guarded by _lock. Statements on
+  it run one at a time; writes are committed per statement.
+- A read-only connection (URI mode=ro) for schema introspection and
+  citation checks, guarded by _ro_lock. Introspection never waits
+  behind a long-running query, and the schema caches are only touched
+  under this lock.
+Lock order is _lock -> _ro_lock (run_sql checks cited tables); nothing
+takes _lock while holding _ro_lock.
+"""
+
+import atexit
 import sqlite3
 import re
+import threading
+from pathlib import Path
 from typing import Dict, Any, List, Tuple
 
+# Default cap on rows materialized by run_sql (protects the LLM prompt)
+MAX_ROWS = 10_000
+
+# SQL tokenizer for extract_tables_used, compiled once. Alternatives, in order:
+# string literal, line/block comment, quoted identifier ("x" / [x] / `x`,
+# captured in groups 1-3), bare word (group 4), any other single character.
+_SQL_TOKEN_RE = re.compile(
+    r"'(?:''|[^'])*'?"
+    r"|--[^\n]*"
+    r"|/\*.*?(?:\*/|\Z)"
+    r'|"([^"]*)"?'
+    r"|\[([^\]]*)\]?"
+    r"|`([^`]*)`?"
+    r"|(\w+)"
+    r"|\S",
+    re.S,
+)
+_TABLE_KEYWORDS = frozenset({"FROM", "JOIN"})
 
 class SQLiteTool:
     """
@@ -12,89 +47,180 @@ class SQLiteTool:
 
     def __init__(self, db_path: str = "../../data/northwind.sqlite"):
         self.db_path = db_path
+        self._schema_cache = None  # {table: (cols,)}, valid for self._schema_version
+        self._table_names = None   # {lower-cased name: name}, valid for self._schema_version
+        self._schema_version = -1
+        self._rw_conn = None
+        self._ro_conn = None
+        # Each connection is shared by all threads; statements on it are serialized
+        self._lock = threading.RLock()
+        self._ro_lock = threading.RLock()
+        atexit.register(self.close)
 
     # -------------------------------------------
     # Connection manager
     # -------------------------------------------
     def _connect(self):
-        return sqlite3.connect(self.db_path)
+        """
+        Return the shared read-write connection, opening and tuning it on first use.
+        """
+        with self._lock:
+            if self._rw_conn is None:
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA temp_store=MEMORY")
+                conn.execute("PRAGMA cache_size=-64000")  # 64 MB page cache
+                self._rw_conn = conn
+            return self._rw_conn
+
+    def _connect_ro(self):
+        """
+        Return the shared read-only connection used for introspection.
+        """
+        with self._ro_lock:
+            if self._ro_conn is None:
+                uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+                self._ro_conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            return self._ro_conn
+
+    def close(self):
+        """
+        Close both connections (reopened lazily on next use).
+        """
+        with self._lock:
+            if self._rw_conn is not None:
+                self._rw_conn.close()
+                self._rw_conn = None
+        with self._ro_lock:
+            if self._ro_conn is not None:
+                self._ro_conn.close()
+                self._ro_conn = None
+
+    def __enter__(self):
+        self._connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     # -------------------------------------------
     # Schema Introspection
     # -------------------------------------------
+    def _sync_schema_version(self):
+        """
+        Drop cached schema data if DDL ran since it was built. PRAGMA
+        schema_version is a single header read that changes on every DDL.
+        """
+        with self._ro_lock:
+            version = self._connect_ro().execute("PRAGMA schema_version").fetchone()[0]
+            if version != self._schema_version:
+                self._schema_cache = None
+                self._table_names = None
+                self._schema_version = version
+
+    def _table_lookup(self) -> Dict[str, str]:
+        """
+        Map of lower-cased table name -> table name, loaded once per
+        schema_version (SQLite table names are case-insensitive).
+        """
+        with self._ro_lock:
+            self._sync_schema_version()
+            if self._table_names is None:
+                cur = self._connect_ro().execute("SELECT name FROM sqlite_master WHERE type='table'")
+                self._table_names = {row[0].lower(): row[0] for row in cur.fetchall()}
+            return self._table_names
+
     def get_tables(self) -> List[str]:
         """
         Return all table names from SQLite.
         """
-        try:
-            conn = self._connect()
-            cur = conn.cursor()
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            tables = [row[0] for row in cur.fetchall()]
-            conn.close()
-            return tables
-        except Exception:
-            return []
+        return list(self._table_lookup().values())
+
+    def is_table(self, name: str) -> bool:
+        """
+        True if `name` is a table in the database (case-insensitive).
+        """
+        return name.lower() in self._table_lookup()
 
     def get_table_columns(self, table: str) -> List[str]:
         """
         Returns list of column names for a given table.
         """
-        try:
-            conn = self._connect()
-            cur = conn.cursor()
-            cur.execute(f"PRAGMA table_info('{table}')")
-            cols = [row[1] for row in cur.fetchall()]
-            conn.close()
-            return cols
-        except Exception:
-            return []
+        with self._ro_lock:
+            cur = self._connect_ro().cursor()
+            # Bound parameter: one cached statement for every table name,
+            # and no quoting/injection issues with names like "Order Details"
+            cur.execute("SELECT name FROM pragma_table_info(?) ORDER BY cid", (table,))
+            return [row[0] for row in cur.fetchall()]
 
     def get_schema_snapshot(self) -> Dict[str, List[str]]:
         """
         Returns the full schema in dict form: {table: [cols]}
+        The snapshot is reused until the database's schema_version changes.
         """
-        schema = {}
-        tables = self.get_tables()
-        for t in tables:
-            schema[t] = self.get_table_columns(t)
-        return schema
+        with self._ro_lock:
+            self._sync_schema_version()
+            if self._schema_cache is None:
+                # One statement for every table's columns (no per-table PRAGMA)
+                cur = self._connect_ro().execute(
+                    "SELECT m.name, p.name "
+                    "FROM sqlite_master AS m, pragma_table_info(m.name) AS p "
+                    "WHERE m.type='table' "
+                    "ORDER BY m.rowid, p.cid"
+                )
+                schema = {}
+                for table, column in cur.fetchall():
+                    schema.setdefault(table, []).append(column)
+                self._schema_cache = {t: tuple(cols) for t, cols in schema.items()}
+            # Cached as tuples; callers get their own lists
+            return {t: list(cols) for t, cols in self._schema_cache.items()}
 
     # -------------------------------------------
     # SQL Execution
     # -------------------------------------------
-    def run_sql(self, query: str) -> Dict[str, Any]:
+    def run_sql(self, query: str, max_rows: int = MAX_ROWS) -> Dict[str, Any]:
         """
         Executes SQL safely and returns:
         {
             'columns': [...],
             'rows': [...],
             'tables_used': [...],
+            'truncated': <bool>,
             'error': <str or None>
         }
+        At most `max_rows` rows are fetched; 'truncated' is True when
+        the query produced more.
         """
         result = {
             "columns": [],
             "rows": [],
-            "tables_used": self.extract_tables_used(query),
+            "tables_used": [],
+            "truncated": False,
             "error": None,
         }
 
-        try:
-            conn = self._connect()
-            cur = conn.cursor()
-            cur.execute(query)
+        with self._lock:
+            try:
+                result["tables_used"] = self.extract_tables_used(query)
+                conn = self._connect()
+                cur = conn.cursor()
+                cur.execute(query)
 
-            # SELECT → fetch
-            if query.strip().lower().startswith("select"):
-                result["columns"] = [desc[0] for desc in cur.description]
-                result["rows"] = cur.fetchall()
+                # Row-producing statement (SELECT, WITH ... SELECT, PRAGMA, ...) → fetch
+                if cur.description is not None:
+                    result["columns"] = [desc[0] for desc in cur.description]
+                    result["rows"] = cur.fetchmany(max_rows)
+                    result["truncated"] = cur.fetchone() is not None
 
-            conn.commit()
-            conn.close()
+                # Only writes open a transaction; plain reads skip the commit
+                if conn.in_transaction:
+                    conn.commit()
 
-        except Exception as e:
-            result["error"] = str(e)
+            except Exception as e:
+                result["error"] = str(e)
+                # The connection is reused, so don't leave a failed write open
+                if self._rw_conn is not None and self._rw_conn.in_transaction:
+                    self._rw_conn.rollback()
 
         return result
 
@@ -103,29 +229,50 @@ class SQLiteTool:
     # -------------------------------------------
     def extract_tables_used(self, query: str) -> List[str]:
         """
-        Very simple parser: extracts table names after FROM / JOIN.
+        Single-pass scanner: extracts table names after FROM / JOIN.
+        String literals and comments are skipped; quoted identifiers
+        ("Order Details", [x], `x`) keep their inner text.
+        Only names of real tables are returned, in their schema casing,
+        so CTE names and aliases of subqueries are not cited.
         """
-        pattern = r"(?:FROM|JOIN)\s+([A-Za-z_][A-Za-z0-9_ ]*)"
-        matches = re.findall(pattern, query, flags=re.IGNORECASE)
+        seen = set()  # lower-cased names, matched against the schema below
+        expect_table = False  # previous token was FROM / JOIN
+
+        for m in _SQL_TOKEN_RE.finditer(query):
+            word = m.group(4)
+            if word is not None:
+                if expect_table:
+                    seen.add(word.lower())
+                    expect_table = False
+                else:
+                    expect_table = word.upper() in _TABLE_KEYWORDS
+                continue
 
-        # Normalize whitespace / quotes
-        cleaned = []
-        for m in matches:
-            name = m.strip().replace('"', "")
-            cleaned.append(name)
+            quoted = m.group(1)
+            if quoted is None:
+                quoted = m.group(2)
+            if quoted is None:
+                quoted = m.group(3)
+            if quoted is not None:
+                if expect_table:
+                    seen.add(quoted.lower())
+                expect_table = False
+            elif not m.group(0).startswith(("--", "/*")):
+                # String literal or punctuation, e.g. FROM (subquery)
+                expect_table = False
 
-        return list(set(cleaned))  # unique
+        tables = self._table_lookup()
+        return [tables[name] for name in seen if name in tables]
 
 
 # Quick test
 if __name__ == "__main__":
-    tool = SQLiteTool()
-
-    print("Tables:", tool.get_tables())
-    q = """
-        SELECT ProductName, UnitPrice
-        FROM Products
-        LIMIT 3;
-    """
-    out = tool.run_sql(q)
-    print(out)
+    with SQLiteTool() as tool:
+        print("Tables:", tool.get_tables())
+        q = """
+            SELECT ProductName, UnitPrice
+            FROM Products
+            LIMIT 3;
+        """
+        out = tool.run_sql(q)
+        print(out)